@@ -12,6 +12,7 @@ class UniformDataLoader(DataLoader):
         batch_size: int,
         num_workers: int = 0,
         pin_memory: bool = True,
+        **kwargs,
     ):
         """Convenience DataLoader with uniform subsampling without replacement.
         Suitable for use with the Gaussian DP privacy accounting used in the library.
@@ -26,6 +27,8 @@ class UniformDataLoader(DataLoader):
             When using CUDA, it should be set to 0 and pin_memory should be set to True.
             pin_memory (bool, optional): [description]. Defaults to True. Use pinned
             memory for allocating the dataset. Recommended when CUDA is used.
+            **kwargs: Further keyword arguments passed on to the DataLoader, such as
+            persistent_workers or prefetch_factor (the latter only with num_workers > 0).
         """
 
         super().__init__(
@@ -33,6 +36,7 @@ class UniformDataLoader(DataLoader):
             batch_sampler=UniformWORSubsampler(dataset=dataset, batch_size=batch_size),
             pin_memory=pin_memory,
             num_workers=num_workers,
+            **kwargs,
         )
 
 
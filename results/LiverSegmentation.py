@@ -15,7 +15,8 @@ from dataloader import (
     MSD_data_images,
     AlbumentationsTorchTransform,
     calc_mean_std,
-    create_albu_transform,
+    binarize_mask,
+    KorniaSegmentationTransform,
 )
 
 from deepee import UniformDataLoader
@@ -52,9 +53,8 @@ trainset = MSD_data_images(args.data_dir + "/train", transform=stats_tf_imgs,)
 # get stats
 mean, std = calc_mean_std(trainset)
 
-# change transforms based on stats
-train_tf = create_albu_transform(args, mean, std)
-trainset.transform = train_tf
+# the training set keeps the resizing transform, augmentation and normalisation
+# based on the stats run batched on the device inside the training step
 # L_train = round(0.85 * len(trainset))
 # trainset, valset = torch.utils.data.random_split(
 #     trainset,
@@ -74,12 +74,8 @@ test_trans = a.Compose(
                 args.img_size,
                 args.img_size,
             ),
-            mask=lambda x, **kwargs: np.where(
-                # binarize masks
-                x.reshape(-1, args.img_size, args.img_size) / 255.0 > 0.5,
-                np.ones_like(x),
-                np.zeros_like(x),
-            ).astype(np.float32),
+            # binarize masks
+            mask=lambda x, **kwargs: binarize_mask(x, args.img_size),
         ),
     ]
 )
@@ -145,7 +141,7 @@ def segmentation_to_RGB(segmentation):
 
 
 # %%
-img_segs = [trainset[i] for i in range(0, len(trainset), 200)]
+img_segs = [valset[i] for i in range(0, len(valset), 200)]
 img_batch = torch.stack([i[0] for i in img_segs])
 seg_batch = torch.stack(
     [torch.from_numpy(np.asarray(i[1], dtype=np.int32)) for i in img_segs]
@@ -175,12 +171,13 @@ class SegmentationNetwork(pl.LightningModule):
         )
         surgeon.operate(self.model)
         self.loss_fn = smp.utils.losses.DiceLoss()
+        self.augment = KorniaSegmentationTransform(args, mean, std)
 
     def forward(self, x):
         return self.model(x)
 
     def training_step(self, batch, batch_idx):
-        data, target = batch
+        data, target = self.augment(*batch)
         pred = self.model(data)
         loss = self.loss_fn(pred, target)
         self.log("train_loss", loss)
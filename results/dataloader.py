@@ -8,9 +8,7 @@ from torch import (  # pylint:disable=no-name-in-module
     manual_seed,
     stack,
     cat,
-    std_mean,
     save,
-    is_tensor,
     from_numpy,
     randperm,
     default_generator,
@@ -18,6 +16,7 @@ from torch import (  # pylint:disable=no-name-in-module
 )
 from torch._utils import _accumulate
 import albumentations as a
+import cv2 as cv
 from copy import deepcopy
 from torch.utils import data as torchdata
 from torchvision.datasets import MNIST
@@ -25,7 +24,7 @@ from torchvision import transforms
 from torchvision.datasets.folder import default_loader
 
 from os.path import splitext
-from typing import Dict, Union, Set, Callable
+from typing import Dict, Union, Set, Callable, Optional
 
 from pathlib import Path
 
@@ -33,6 +32,15 @@ from sklearn.model_selection import LeaveOneOut
 
 from typing import Callable
 
+# optional: libjpeg-turbo decoding for JPEGs, falls back to PIL (or a
+# Pillow-SIMD installation, which is a drop-in replacement) if unavailable
+try:
+    from turbojpeg import TurboJPEG, TJPF_GRAY, TJPF_RGB
+
+    turbo_jpeg = TurboJPEG()
+except (ImportError, OSError, RuntimeError):
+    turbo_jpeg = None
+
 
 class AlbumentationsTorchTransform:
     def __init__(self, transform, **kwargs):
@@ -41,32 +49,27 @@ class AlbumentationsTorchTransform:
         self.kwargs = kwargs
 
     def __call__(self, img, mask=None):
-        # print("call albu transform wrapper")
-        if Image.isImageType(img):
-            img = np.array(img)
-        elif is_tensor(img):
-            img = img.cpu().numpy()
-        if mask is not None:
-            if Image.isImageType(mask):
-                mask = np.array(mask)
-            elif is_tensor(mask):
-                mask = mask.cpu().numpy()
+        """Expects `img` (and `mask`) as HWC or HW numpy arrays, the way albumentations
+        consumes them, and returns CHW tensors."""
+        assert isinstance(img, np.ndarray), "img has to be a numpy array"
+        assert mask is None or isinstance(
+            mask, np.ndarray
+        ), "mask has to be a numpy array"
         img = self.transform(image=img, mask=mask, **self.kwargs)
         if mask is not None:
-            mask = img["mask"]
-        img = img["image"]
-        img = from_numpy(img)
-        if img.shape[-1] < img.shape[0]:
-            img = img.permute(2, 0, 1)
-        if mask is not None:
-            mask = from_numpy(mask)
-            if mask.shape[-1] < mask.shape[0]:
-                mask = mask.permute(2, 0, 1)
+            mask = self.to_tensor(img["mask"])
+        img = self.to_tensor(img["image"])
         if mask is None:
             return img
         else:
             return img, mask
 
+    @staticmethod
+    def to_tensor(arr):
+        if arr.ndim == 3 and arr.shape[-1] < arr.shape[0]:
+            arr = arr.transpose(2, 0, 1)
+        return from_numpy(np.ascontiguousarray(arr))
+
 
 def create_albu_transform(args, mean, std):
 
@@ -84,24 +87,85 @@ def create_albu_transform(args, mean, std):
         a.Normalize(mean=mean, std=std, max_pixel_value=1.0),
         a.Lambda(
             image=lambda x, **kwargs: x.reshape(-1, args.img_size, args.img_size),
-            mask=lambda x, **kwargs: np.where(
-                x.reshape(-1, args.img_size, args.img_size) / 255.0 > 0.5,
-                np.ones_like(x),
-                np.zeros_like(x),
-            ).astype(np.float32),
+            mask=lambda x, **kwargs: binarize_mask(x, args.img_size),
         ),
     ]
     train_tf_albu = AlbumentationsTorchTransform(a.Compose(transformations,))
     return train_tf_albu
 
 
+def binarize_mask(mask: np.ndarray, img_size: int) -> np.ndarray:
+    """Binarizes a [0, 255] mask at 0.5 and reshapes it to (-1, img_size, img_size)"""
+    mask = cv.threshold(mask, 127, 1, cv.THRESH_BINARY)[1]
+    return mask.reshape(-1, img_size, img_size).astype(np.float32)
+
+
+class KorniaSegmentationTransform(torch.nn.Module):
+    """Batched counterpart of `create_albu_transform` for (image, mask) pairs which
+    runs on the device of its inputs. Expects batches of images scaled to [0, 1] and
+    [0, 255] masks, both already resized to args.img_size (e.g. by the dataset)."""
+
+    def __init__(self, args, mean, std):
+        super().__init__()
+        try:
+            import kornia as K
+        except ImportError as e:
+            raise ImportError(
+                "To use the batched augmentations, kornia must be installed."
+            ) from e
+        self.img_size = args.img_size
+        self.geometric = K.augmentation.AugmentationSequential(
+            K.augmentation.RandomAffine(
+                degrees=args.rotation,
+                translate=(args.translate, args.translate),
+                scale=(1.0 - args.scale, 1.0 + args.scale),
+                padding_mode="reflection",
+                p=0.5,
+            ),
+            K.augmentation.RandomVerticalFlip(p=args.individual_albu_probs),
+            data_keys=["input", "mask"],
+        )
+        # albumentations adds the noise before ToFloat, i.e. in [0, 255] units
+        self.noise = K.augmentation.RandomGaussianNoise(
+            std=args.noise_std / 255.0, p=args.noise_prob
+        )
+        self.normalize = K.enhance.Normalize(
+            mean=torch.as_tensor(mean).reshape(-1), std=torch.as_tensor(std).reshape(-1)
+        )
+
+    @torch.no_grad()
+    def forward(self, img, mask):
+        img = img.reshape(-1, 1, self.img_size, self.img_size).float()
+        mask = mask.reshape(-1, 1, self.img_size, self.img_size).float() / 255.0
+        img, mask = self.geometric(img, mask)
+        img = self.normalize(self.noise(img))
+        return img, (mask > 0.5).float()
+
+
+def loo_mean_std(sums: tensor, sq_sums: tensor, sample_numel: int):
+    """Leave-one-out mean and standard deviation over all elements of a dataset,
+    dropping one sample at a time. Takes the per-sample sums and sums of squares
+    (each sample having `sample_numel` elements) and uses the closed forms,
+    so it needs O(N) work instead of N reductions."""
+    count = (sums.shape[0] - 1) * sample_numel
+    loo_means = (sums.sum() - sums) / count
+    loo_vars = (sq_sums.sum() - sq_sums - count * loo_means ** 2) / (count - 1)
+    return loo_means, loo_vars.clamp(min=0).sqrt()
+
+
 def l1_sensitivity(query: Callable, d: tensor) -> float:
     """Calculates L1-sensitivity of a query on a dataset."""
+    if query is torch.mean or query is torch.std:
+        flat = d.reshape(d.shape[0], -1).double()
+        loo_means, loo_stds = loo_mean_std(
+            flat.sum(1), (flat ** 2).sum(1), flat.shape[1]
+        )
+        vals = loo_means if query is torch.mean else loo_stds
+        return max(vals.max().item(), 0)
     L = LeaveOneOut()
-    data = d.copy()
     sensitivity = 0
-    for idx in L.split(data):
-        val = query(data[idx[0]])
+    for idx in L.split(d):
+        val = query(d[idx[0]])
         if val > sensitivity:
             sensitivity = val
     return sensitivity
@@ -114,40 +178,69 @@ def calc_mean_std(
     Calculates the mean and standard deviation of `dataset` and
     saves them to `save_folder`.
 
-    Needs a dataset where all images have the same size.
+    Needs a dataset where all images have the same size. The statistics
+    are accumulated sample by sample (Welford / Chan et al.), so the
+    dataset never has to fit into memory at once.
 
     If epsilon is provided, does so in a differentially private way.
     """
+    if isinstance(dataset, torchdata.Dataset):
+        batched = False
+    elif isinstance(dataset, torchdata.DataLoader):
+        batched = True
+    else:
+        raise NotImplementedError("don't know how to process this data input class")
 
-    accumulated_data = []
+    count, mean, m2 = 0, 0.0, 0.0
+    dims, dtype, depth = None, None, None
+    sample_sums, sample_sq_sums = [], []
     for d in tqdm(
         dataset, total=len(dataset), leave=False, desc="accumulate data in dataset"
     ):
-        while type(d) is tuple or type(d) is list:
+        if depth is None:
+            # samples share their structure, so the nesting is only inspected once
+            depth, probe = 0, d
+            while type(probe) is tuple or type(probe) is list:
+                depth, probe = depth + 1, probe[0]
+        for _ in range(depth):
             d = d[0]
-        accumulated_data.append(d)
-    if isinstance(dataset, torchdata.Dataset):
-        accumulated_data = stack(accumulated_data)
-    elif isinstance(dataset, torchdata.DataLoader):
-        accumulated_data = cat(accumulated_data)
-    else:
-        raise NotImplementedError("don't know how to process this data input class")
-    if accumulated_data.shape[1] in [1, 3]:  # ugly hack
-        dims = (0, *range(2, len(accumulated_data.shape)))
-    else:
-        dims = (*range(len(accumulated_data.shape)),)
+        if not batched:
+            d = d.unsqueeze(0)
+        if dims is None:
+            dtype = d.dtype
+            if d.shape[1] in [1, 3]:  # ugly hack
+                dims = (0, *range(2, len(d.shape)))
+            else:
+                dims = (*range(len(d.shape)),)
+        d = d.double()
+        batch_mean = d.mean(dim=dims, keepdim=True)
+        batch_m2 = ((d - batch_mean) ** 2).sum(dim=dims)
+        batch_mean = batch_mean.reshape(batch_m2.shape)
+        batch_count = d.numel() // batch_m2.numel()
+        # merge the batch statistics into the running ones
+        delta = batch_mean - mean
+        new_count = count + batch_count
+        mean = mean + delta * batch_count / new_count
+        m2 = m2 + batch_m2 + delta ** 2 * count * batch_count / new_count
+        count = new_count
+        if epsilon:
+            flat = d.reshape(d.shape[0], -1)
+            sample_sums.append(flat.sum(1))
+            sample_sq_sums.append((flat ** 2).sum(1))
+    std = (m2 / (count - 1)).sqrt().to(dtype)
+    mean = mean.to(dtype)
     if epsilon:
-        mean_sens = l1_sensitivity(torch.mean, accumulated_data)
-        std_sens = l1_sensitivity(torch.std, accumulated_data)
-        std, mean = std_mean(accumulated_data, dim=dims)
+        loo_means, loo_stds = loo_mean_std(
+            cat(sample_sums), cat(sample_sq_sums), flat.shape[1]
+        )
+        mean_sens = max(loo_means.max().item(), 0)
+        std_sens = max(loo_stds.max().item(), 0)
         std += torch.distributions.laplace.Laplace(
             loc=0, scale=std_sens / epsilon
         ).rsample()
         mean += torch.distributions.laplace.Laplace(
             loc=0, scale=mean_sens / epsilon
         ).rsample()
-    else:
-        std, mean = std_mean(accumulated_data, dim=dims)
     if save_folder:
         save(stack([mean, std]), os.path.join(save_folder, "mean_std.pt"))
     return mean, std
@@ -160,10 +253,35 @@ def single_channel_loader(filename):
         return img.copy()
 
 
+def fast_loader(filename, mode="RGB") -> np.ndarray:
+    """Loads `filename` as a HWC (or HW for mode "L") uint8 numpy array.
+    JPEGs are decoded with libjpeg-turbo if PyTurboJPEG is installed."""
+    if turbo_jpeg is not None and splitext(filename)[1].lower() in (".jpg", ".jpeg"):
+        with open(filename, "rb") as f:
+            img = turbo_jpeg.decode(
+                f.read(), pixel_format=TJPF_GRAY if mode == "L" else TJPF_RGB
+            )
+        return img[..., 0] if mode == "L" else img
+    with open(filename, "rb") as f:
+        return np.array(Image.open(f).convert(mode))
+
+
 class LabelMNIST(MNIST):
     def __init__(self, labels, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        indices = np.isin(self.targets, labels).astype("bool")
+        # membership lookup table over all label values instead of np.isin
+        targets = self.targets.numpy()
+        if isinstance(labels, (set, frozenset)):
+            labels = list(labels)
+        labels = np.atleast_1d(np.asarray(labels, dtype=np.int64))
+        # targets are never negative, so such labels can't match (and would wrap)
+        labels = labels[labels >= 0]
+        size = int(targets.max()) + 1
+        if labels.size:
+            size = max(size, int(labels.max()) + 1)
+        keep = np.zeros(size, dtype=bool)
+        keep[labels] = True
+        indices = from_numpy(keep[targets])
         self.data = self.data[indices]
         self.targets = self.targets[indices]
 
@@ -192,57 +310,73 @@ class PathDataset(torchdata.Dataset):
         self.root = root
         self.transform = transform
         self.loader = loader
-        self.imgs = [
-            f
-            for f in os.listdir(root)
-            if os.path.splitext(f)[1].lower() in extensions
-            and not os.path.split(f)[1].lower().startswith("._")
-        ]
+        extensions = frozenset(extensions)
+        # full paths are stored so __getitem__ doesn't have to join them
+        with os.scandir(root) as entries:
+            self.imgs = [
+                e.path
+                for e in entries
+                if e.is_file()
+                and os.path.splitext(e.name)[1].lower() in extensions
+                and not e.name.startswith("._")
+            ]
 
     def __len__(self):
         return len(self.imgs)
 
     def __getitem__(self, idx):
-        img_path = self.imgs[idx]
-        img = self.loader(os.path.join(self.root, img_path))
+        img = self.loader(self.imgs[idx])
         if self.transform:
             img = self.transform(img)
         return img
 
 
 class RemoteTensorDataset(torchdata.Dataset):
-    def __init__(self, tensor):
+    def __init__(self, tensor, clone=False):
+        # items are views into `tensor` unless `clone` is set, which is only needed
+        # if the consumer modifies them in place
         self.tensor = tensor
+        self.clone = clone
 
     def __len__(self):
         return self.tensor.shape[0]
 
     def __getitem__(self, idx):
-        return self.tensor[idx].copy()
+        item = self.tensor[idx]
+        if self.clone:
+            return item.clone() if torch.is_tensor(item) else item.copy()
+        return item
 
 
 ##This is from torch.data.utils and adapted for our purposes
 class Subset(torchdata.Dataset):
-    def __init__(self, dataset, indices):
-        self.dataset = deepcopy(dataset)
-        self.indices = indices
+    def __init__(self, dataset, indices, copy=False):
+        # the dataset is shared between subsets unless `copy` is set, which is only
+        # needed if the subsets have to be modified independently (e.g. transforms)
+        self.dataset = deepcopy(dataset) if copy else dataset
+        self.indices = np.asarray(indices, dtype=np.int64)
 
     def __getitem__(self, idx):
         return self.dataset[self.indices[idx]]
 
+    def __getitems__(self, indices):
+        if callable(getattr(self.dataset, "__getitems__", None)):
+            return self.dataset.__getitems__(self.indices[indices])
+        return [self[idx] for idx in indices]
+
     def __len__(self):
         return len(self.indices)
 
 
-def random_split(dataset, lengths, generator=default_generator):
+def random_split(dataset, lengths, generator=default_generator, copy=False):
     if sum(lengths) != len(dataset):
         raise ValueError(
             "Sum of input lengths does not equal the length of the input dataset!"
         )
 
-    indices = randperm(sum(lengths), generator=generator).tolist()
+    indices = randperm(sum(lengths), generator=generator).numpy()
     return [
-        Subset(dataset, indices[offset - length : offset])
+        Subset(dataset, indices[offset - length : offset], copy=copy)
         for offset, length in zip(_accumulate(lengths), lengths)
     ]
 
@@ -263,7 +397,8 @@ from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import minmax_scale
 import cv2 as cv
 import math
-from skimage.transform import resize
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 from nilearn.image import resample_img
 from pathlib import Path, WindowsPath, PureWindowsPath, PosixPath, PurePosixPath
 from tqdm import tqdm
@@ -280,17 +415,16 @@ def scale_array(array: np.array) -> np.array:
 
 
 def preprocess_scan(scan) -> np.array:
-    """Performs Preprocessing: (1) clips vales to -150 to 200, (2) scales values to lie in between 0 and 1,
-    (3) peforms rotations and flipping to move patient into referen position
-        (3) peforms rotations and flipping to move patient into referen position
-    (3) peforms rotations and flipping to move patient into referen position
-    Return: np.array"""
-    scan = np.clip(scan, -150, 200)
-    scan = scale_array(scan)
-    scan = np.rot90(scan)
-    scan = np.fliplr(scan)
+    """Performs Preprocessing: (1) clips vales to -150 to 200, (2) scales values to lie in between 0 and 1.
+    The rotation and flipping into the reference position is done by resize_volume(reorient=True)
+    Return: np.array (float32)"""
+    # the clip range is fixed, so the values are scaled by it directly
+    out = np.empty(scan.shape, dtype=np.float32)
+    np.clip(scan, -150, 200, out=out, casting="unsafe")
+    out += 150
+    out *= 1.0 / 350.0
 
-    return scan
+    return out
 
 
 def rotate_label(label_volume) -> np.array:
@@ -312,7 +446,7 @@ def preprocess_and_convert_to_numpy(
     np_label = nifti_mask.get_fdata()
     nifti_mask.uncache()
     nifti_scan.uncache()
-    np_scan = preprocess_scan(np_scan)
+    np_scan = np.fliplr(np.rot90(preprocess_scan(np_scan)))
     np_label = rotate_label(np_label)
     assert np_scan.shape == np_label.shape
 
@@ -333,10 +467,8 @@ def merge_labels(label_volume: np.array) -> np.array:
     """Merges Tumor and Pancreas labels into one volume with background=0, pancreas & tumor = 1
     Input: label_volume = 3D numpy array
     Return: Merged Label volume"""
-    merged_label = np.zeros(label_volume.shape, dtype=np.float32)
-    merged_label[label_volume == 1] = 1.0
-    merged_label[label_volume == 2] = 1.0
-    return merged_label
+    # the pancreas task only has the labels 0, 1 and 2
+    return np.asarray(label_volume > 0, dtype=np.float32)
 
 
 def bbox_dim_3D(img: np.array):
@@ -345,18 +477,12 @@ def bbox_dim_3D(img: np.array):
        Input: img = 3D numpy array,
     Input: img = 3D numpy array,
     Return: row-min, row-max, collumn-min, collumn-max, z-min, z_max"""
-    if np.nonzero(img)[0].size == 0:
+    r, c, z = np.nonzero(img)
+    if r.size == 0:
         print("Warning Empty Label Mask")
         return None
-    r = np.any(img, axis=(1, 2))
-    c = np.any(img, axis=(0, 2))
-    z = np.any(img, axis=(0, 1))
 
-    rmin, rmax = np.where(r)[0][[0, -1]]
-    cmin, cmax = np.where(c)[0][[0, -1]]
-    zmin, zmax = np.where(z)[0][[0, -1]]
-
-    return rmin, rmax, cmin, cmax, zmin, zmax
+    return r.min(), r.max(), c.min(), c.max(), z.min(), z.max()
 
 
 def create_2D_label(rmin: int, rmax: int, cmin: int, cmax: int, res: int) -> np.array:
@@ -395,11 +521,9 @@ def convert_to_2d(arr: np.array) -> np.array:
     return np.moveaxis(reshaped, -1, 0)
 
 
-def crop_volume(
-    data_volume: np.array, label_volume: np.array, crop_height: int = 32
-) -> np.array:
-    """Crops two 3D Numpy array along the zaxis to crop_height. Finds the midpoint of the pancreas label along the z-axis and crops [..., zmiddle-(crop_height//2):zmiddle+(crop_height//2)].
-    Return: two np.array s"""
+def crop_range(label_volume: np.array, crop_height: int = 32) -> tuple:
+    """Finds the z-range of height crop_height around the midpoint of the pancreas label.
+    Return: z_min, z_max"""
     rmin, rmax, cmin, cmax, zmin, zmax = bbox_dim_3D(label_volume)
 
     zmiddle = (zmin + zmax) // 2
@@ -407,12 +531,111 @@ def crop_volume(
     if z_min < 0:
         z_min = 0
     z_max = zmiddle + (crop_height // 2)
+    return z_min, z_max
+
+
+def crop_volume(
+    data_volume: np.array, label_volume: np.array, crop_height: int = 32
+) -> np.array:
+    """Crops two 3D Numpy array along the zaxis to crop_height. Finds the midpoint of the pancreas label along the z-axis and crops [..., zmiddle-(crop_height//2):zmiddle+(crop_height//2)].
+    Return: two np.array s"""
+    z_min, z_max = crop_range(label_volume, crop_height=crop_height)
     cropped_data_volume = data_volume[:, :, z_min:z_max]
     cropped_label_volume = label_volume[:, :, z_min:z_max]
 
     return cropped_data_volume, cropped_label_volume
 
 
+def reorientation_matrix(shape: tuple, res: int) -> np.array:
+    """Creates the inverse 2x3 affine map for cv.warpAffine which rotates (np.rot90) and flips
+    (np.fliplr) a slice of the given shape and resizes it to (res, res) in one step
+    Return: np.array"""
+    rows, cols = shape
+    # the reoriented slice has shape (cols, rows), pixel centres are aligned as in cv.resize
+    row_scale, col_scale = cols / res, rows / res
+    return np.array(
+        [
+            [0.0, -row_scale, cols - 0.5 - 0.5 * row_scale],
+            [-col_scale, 0.0, rows - 0.5 - 0.5 * col_scale],
+        ]
+    )
+
+
+def resize_volume(
+    volume: np.array,
+    res: int,
+    res_z: int,
+    interpolation: int = cv.INTER_LINEAR,
+    reorient: bool = False,
+) -> np.array:
+    """Resizes a 3D volume to (res, res, res_z) with OpenCV. Every z-slice is resized
+    in-plane first, afterwards the volume is resampled along the z-axis row by row.
+    If reorient is set, the slices are also rotated and flipped into the reference position.
+    Return: np.array"""
+    height = volume.shape[2]
+    resized = np.empty((res, res, height), dtype=volume.dtype)
+    if reorient:
+        M = reorientation_matrix(volume.shape[:2], res)
+        # the map is already centre-aligned and warpAffine's nearest rounds, which is
+        # what INTER_NEAREST_EXACT does in cv.resize (warpAffine doesn't accept it)
+        warp_interpolation = interpolation
+        if interpolation == cv.INTER_NEAREST_EXACT:
+            warp_interpolation = cv.INTER_NEAREST
+    for k in range(height):
+        volume_slice = np.ascontiguousarray(volume[:, :, k])
+        if reorient:
+            resized[:, :, k] = cv.warpAffine(
+                volume_slice,
+                M,
+                (res, res),
+                flags=warp_interpolation | cv.WARP_INVERSE_MAP,
+                borderMode=cv.BORDER_REPLICATE,
+            )
+        else:
+            resized[:, :, k] = cv.resize(
+                volume_slice, (res, res), interpolation=interpolation
+            )
+    if height == res_z:
+        return resized
+    resampled = np.empty((res, res, res_z), dtype=volume.dtype)
+    for i in range(res):
+        # each row is a (res, height) image, only its width changes
+        resampled[i] = cv.resize(resized[i], (res_z, res), interpolation=interpolation)
+    return resampled
+
+
+# the umask can only be read by setting it, which is done once here instead of in
+# save_atomic since that runs in the loader threads of MSD_data.__getitems__
+UMASK = os.umask(0)
+os.umask(UMASK)
+
+
+def save_atomic(path: Path, array: np.array) -> None:
+    """Saves `array` to `path` via a temporary file in the same folder, so that an
+    interrupted write never leaves a truncated file under the final name"""
+    with tempfile.NamedTemporaryFile(
+        dir=path.parent, prefix=path.name, suffix=".tmp", delete=False
+    ) as f:
+        tmp_path = f.name
+        try:
+            np.save(f, array)
+        except BaseException:
+            f.close()
+            os.remove(tmp_path)
+            raise
+    # temporary files are created with 0600, give the file the usual permissions
+    os.chmod(tmp_path, 0o666 & ~UMASK)
+    os.replace(tmp_path, path)
+
+
+def numpy_to_tensor(array: np.array) -> torch.Tensor:
+    """Shares the memory of `array` with the returned tensor, only copies if the array
+    is not C-contiguous or read-only (e.g. memory-mapped)"""
+    if not (array.flags.c_contiguous and array.flags.writeable):
+        array = np.array(array, order="C")
+    return from_numpy(array)
+
+
 class MSD_data(torchdata.Dataset):
     def __init__(
         self,
@@ -426,6 +649,8 @@ class MSD_data(torchdata.Dataset):
         mrg_labels: bool = True,
         transform: Callable = lambda x: x,
         target_transform: Callable = lambda x: x,
+        cache_dir: Optional[str] = None,
+        io_threads: int = 4,
     ):
         self.path_string = path_string
         self.res = res
@@ -437,6 +662,18 @@ class MSD_data(torchdata.Dataset):
         self.mrg_labels = mrg_labels
         self.transform = transform
         self.target_transform = target_transform
+        # preprocessed volumes are stored here on first access and memory-mapped
+        # afterwards, in a subfolder per preprocessing configuration
+        self.cache_dir = None
+        if cache_dir is not None:
+            config_tag = (
+                f"res{res}x{res_z}_crop{crop_height}_{label_mode}"
+                f"_{'merged' if mrg_labels else 'unmerged'}"
+            )
+            self.cache_dir = Path(cache_dir) / config_tag
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+        # number of threads loading the samples of a batch, see __getitems__
+        self.io_threads = io_threads
 
         # as in original function
         assert (crop_height % 16) == 0
@@ -485,6 +722,8 @@ class MSD_data(torchdata.Dataset):
         return len(self.scan_names) if self.sample_limit == -1 else self.sample_limit
 
     def __getitem__(self, key):
+        if isinstance(key, np.integer):
+            key = int(key)
         if isinstance(key, slice):
             # get the start, stop, and step from the slice
             return [self[ii] for ii in range(*key.indices(len(self)))]
@@ -499,15 +738,24 @@ class MSD_data(torchdata.Dataset):
         else:
             raise TypeError("Invalid argument type.")
 
-    def get_item_from_index(self, index):
+    def __getitems__(self, keys):
+        """Loads the samples of a batch concurrently, NIfTI decompression releases the GIL"""
+        keys = [int(key) for key in keys]
+        if self.io_threads <= 1:
+            return [self.get_item_from_index(key) for key in keys]
+        with ThreadPoolExecutor(self.io_threads) as executor:
+            return list(executor.map(self.get_item_from_index, keys))
+
+    def load_volumes(self, index):
+        """Loads and preprocesses scan and label, returns both resized to (res, res, res_z)"""
         scan_id = self.scan_names[index]
         label_id = self.label_names[index]
 
-        scan = nib.load(str(scan_id))
-        label = nib.load(str(label_id))
-
-        # preprocessing scan and label, extracting np array data
-        scan, label = preprocess_and_convert_to_numpy(scan, label)
+        # the label is processed first so that only the slices of the scan
+        # which survive the crop have to be read and preprocessed
+        label_nifti = nib.load(str(label_id))
+        label = np.asarray(label_nifti.dataobj)
+        label_nifti.uncache()
 
         # merging tumor and pancreas labels in the label mask
         if self.mrg_labels:
@@ -520,26 +768,54 @@ class MSD_data(torchdata.Dataset):
                 print(
                     "Couldn't generate a bounding box for the label in scan:", scan_id
                 )
-            # creating label mask from bounding box dimensions
-            label = create_3D_label(
-                b[0], b[1], b[2], b[3], b[4], b[5], label.shape[1], label.shape[2],
-            )
+            # creating label mask from bounding box dimensions,
+            # the label buffer is overwritten instead of allocating a new volume.
+            # The box excludes its max edges in the reoriented frame, which are the
+            # min edges in this (not yet rotated and flipped) one
+            label.fill(0)
+            label[b[0] + 1 : b[1] + 1, b[2] + 1 : b[3] + 1, b[4] : b[5]] = 1
 
         # cropping scan and label volumes to reduce the number of non-pancreas slices
-        cropped_scan, cropped_label = crop_volume(
-            scan, label, crop_height=self.crop_height
+        z_min, z_max = crop_range(label, crop_height=self.crop_height)
+        cropped_label = label[:, :, z_min:z_max]
+        cropped_scan = preprocess_scan(
+            np.asarray(
+                nib.load(str(scan_id)).dataobj[:, :, z_min:z_max], dtype=np.float32
+            )
         )
         assert cropped_scan.shape == cropped_label.shape
 
-        scan = resize(
-            cropped_scan, (self.res, self.res, self.res_z), preserve_range=True, order=1
-        ).astype(np.float32)
-        label = resize(
-            cropped_label,
-            (self.res, self.res, self.res_z),
-            preserve_range=True,
-            order=0,
+        scan = resize_volume(
+            cropped_scan.astype(np.float32, copy=False),
+            self.res,
+            self.res_z,
+            interpolation=cv.INTER_LINEAR,
+            reorient=True,
+        )
+        label = resize_volume(
+            cropped_label.astype(np.float32, copy=False),
+            self.res,
+            self.res_z,
+            interpolation=cv.INTER_NEAREST_EXACT,
+            reorient=True,
         ).astype(np.uint8)
+        return scan, label
+
+    def get_item_from_index(self, index):
+        if self.cache_dir is None:
+            scan, label = self.load_volumes(index)
+        else:
+            # keyed by the scan's file name, the rglob order is not stable
+            stem = Path(self.scan_names[index]).name.split(".")[0]
+            scan_cache = self.cache_dir / f"{stem}.scan.npy"
+            label_cache = self.cache_dir / f"{stem}.label.npy"
+            if scan_cache.exists() and label_cache.exists():
+                scan = np.load(scan_cache, mmap_mode="r")
+                label = np.load(label_cache, mmap_mode="r")
+            else:
+                scan, label = self.load_volumes(index)
+                save_atomic(scan_cache, scan)
+                save_atomic(label_cache, label)
 
         if self.mode == "2D":
             # print("... converting data to 2D slices")
@@ -557,11 +833,10 @@ class MSD_data(torchdata.Dataset):
             scan = np.expand_dims(scan, 1)
             # label = np.expand_dims(label, 1)
 
-        # convert to tensors
-        # convert to tensors
+        # convert to tensors, the label cast already creates a fresh C-ordered array
         return (
-            self.transform(from_numpy(scan.copy())),
-            self.target_transform(from_numpy(label.copy()).long()),
+            self.transform(numpy_to_tensor(scan)),
+            self.target_transform(from_numpy(label.astype(np.int64, order="C"))),
         )
 
 
@@ -634,8 +909,8 @@ class MSD_data_images(torchdata.Dataset):
         scan_path = self.input_path + f"{index}.jpg"
         label_path = self.target_path + f"{index}.jpg"
 
-        scan_img = Image.open(scan_path)
-        label_img = Image.open(label_path)
+        scan_img = fast_loader(scan_path, mode="L")
+        label_img = fast_loader(label_path, mode="L")
 
         img, label = self.transform(scan_img, mask=label_img)
         return img, self.target_transform(label)
@@ -668,18 +943,29 @@ SEG_LABELS_LIST = [
     {"id": 22, "name": "boat", "rgb_values": [192, 64, 0]},
 ]
 
+# RGB triples packed into a single integer key (r << 16 | g << 8 | b), sorted so
+# that a target image can be mapped to label ids with one np.searchsorted pass
+_seg_keys = np.array(
+    [
+        (r << 16) | (g << 8) | b
+        for r, g, b in (l["rgb_values"] for l in SEG_LABELS_LIST)
+    ],
+    dtype=np.uint32,
+)
+_seg_order = np.argsort(_seg_keys)
+SEG_LABEL_KEYS = _seg_keys[_seg_order]
+SEG_LABEL_IDS = np.array([l["id"] for l in SEG_LABELS_LIST], dtype=np.int64)[
+    _seg_order
+]
 
-def label_img_to_rgb(label_img):
-    label_img = np.squeeze(label_img)
-    labels = np.unique(label_img)
-    label_infos = [l for l in SEG_LABELS_LIST if l["id"] in labels]
+# label id -> RGB palette, ids without an entry map to their own grey value
+SEG_LABEL_PALETTE = np.repeat(np.arange(256, dtype=np.uint8)[:, None], 3, axis=1)
+for _l in SEG_LABELS_LIST:
+    SEG_LABEL_PALETTE[_l["id"]] = _l["rgb_values"]
 
-    label_img_rgb = np.array([label_img, label_img, label_img]).transpose(1, 2, 0)
-    for l in label_infos:
-        mask = label_img == l["id"]
-        label_img_rgb[mask] = l["rgb_values"]
 
-    return label_img_rgb.astype(np.uint8)
+def label_img_to_rgb(label_img):
+    return SEG_LABEL_PALETTE[np.squeeze(label_img)]
 
 
 class SegmentationData(torchdata.Dataset):
@@ -690,6 +976,8 @@ class SegmentationData(torchdata.Dataset):
             self.image_names = f.read().splitlines()
 
     def __getitem__(self, key):
+        if isinstance(key, np.integer):
+            key = int(key)
         if isinstance(key, slice):
             # get the start, stop, and step from the slice
             return [self[ii] for ii in range(*key.indices(len(self)))]
@@ -727,14 +1015,18 @@ class SegmentationData(torchdata.Dataset):
             os.path.join(self.root_dir_name, "targets", img_id + "_GT.bmp")
         )
         target = center_crop(target)
-        target = np.array(target, dtype=np.int64)
-
-        target_labels = target[..., 0]
-        for label in SEG_LABELS_LIST:
-            mask = np.all(target == label["rgb_values"], axis=2)
-            target_labels[mask] = label["id"]
-
-        target_labels = from_numpy(target_labels.copy())
+        target = np.asarray(target, dtype=np.uint32)
+
+        # single pass: pack RGB into one key and look it up in the sorted key table,
+        # pixels with an unknown colour keep their red channel value as before
+        key = (target[..., 0] << 16) | (target[..., 1] << 8) | target[..., 2]
+        idx = np.searchsorted(SEG_LABEL_KEYS, key)
+        np.minimum(idx, len(SEG_LABEL_KEYS) - 1, out=idx)
+        target_labels = np.where(
+            SEG_LABEL_KEYS[idx] == key, SEG_LABEL_IDS[idx], target[..., 0]
+        ).astype(np.int64)
+
+        target_labels = from_numpy(target_labels)
 
         return img, target_labels
 
@@ -25,3 +25,13 @@ def test_dataloader():
         assert (
             len(set(item)) == 50
         )  # always returns correct batch size and never the same item twice
+
+
+def test_dataloader_kwargs():
+    dl_workers = UniformDataLoader(
+        ds, 50, num_workers=2, persistent_workers=True, prefetch_factor=2
+    )
+    assert dl_workers.persistent_workers
+    assert dl_workers.prefetch_factor == 2
+    for item in dl_workers:
+        assert item.unique().numel() == 50